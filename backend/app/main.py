@@ -1,23 +1,38 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import asyncio
 import hashlib
 import os
 import re
+from collections import OrderedDict
 from urllib.parse import urlparse, urljoin
 
+import aiohttp
+import numpy as np
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
+from bs4 import BeautifulSoup, SoupStrainer
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 from pinecone import Pinecone, ServerlessSpec
+import torch
+
+# inference only: no autograd bookkeeping, use every core for intra-op math
+torch.set_grad_enabled(False)
+torch.set_num_threads(os.cpu_count() or 1)
+torch.set_num_interop_threads(1)
 
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_REGION = os.getenv("PINECONE_REGION", "us-east-1")
 
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# "onnx" runs the published int8 AVX512-VNNI export via onnxruntime; set to
+# "torch" for models without an ONNX export
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
 CHUNK_TOKEN_LIMIT = int(os.getenv("CHUNK_TOKEN_LIMIT", "500"))
 TOP_K = int(os.getenv("TOP_K", "10"))
 MAX_PAGES = int(os.getenv("MAX_PAGES", "6"))   # crawl budget (start URL + up to N-1 links)
@@ -30,13 +45,26 @@ app.add_middleware(
 
 _embedder = None
 _pc = None
+_indexed_sites = set()  # site_ids known to have vectors in the index
 
 def get_embedder():
     global _embedder
     if _embedder is None:
-        _embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        if EMBEDDING_BACKEND == "onnx":
+            _embedder = SentenceTransformer(
+                EMBEDDING_MODEL_NAME, backend="onnx",
+                model_kwargs={"file_name": "onnx/model_qint8_avx512_vnni.onnx"},
+            )
+        else:
+            _embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+            _embedder.eval()
     return _embedder
 
+@app.on_event("startup")
+def _warmup():
+    # load + trace the model before the first request hits /search
+    get_embedder().encode(["warmup"])
+
 def pc():
     global _pc
     if _pc is None:
@@ -54,17 +82,56 @@ def ensure_index(name: str, dim: int):
             spec=ServerlessSpec(cloud="aws", region=PINECONE_REGION),
         )
 
+_WS_RE = re.compile(r"\s+")
+
 def normalize_space(s: str) -> str:
-    return re.sub(r"\s+", " ", s).strip()
+    return _WS_RE.sub(" ", s).strip()
+
+_FETCH_HEADERS = {
+    "User-Agent": "WebsiteContentSearch/1.0 (+https://github.com/Mohamed-Fasidh/Website-Content-Search)",
+    # no explicit Accept-Encoding: each client advertises only the codecs it
+    # can actually decode (br would need the brotli package installed)
+}
+
+_http = requests.Session()
+_http.headers.update(_FETCH_HEADERS)
+for _scheme in ("http://", "https://"):
+    _http.mount(_scheme, requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
+_aio_session = None
+
+async def get_aio_session():
+    # lazy so the session binds to uvicorn's event loop; kept open across
+    # requests for connection reuse
+    global _aio_session
+    if _aio_session is None or _aio_session.closed:
+        _aio_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=10),
+            timeout=aiohttp.ClientTimeout(total=30),
+            headers=_FETCH_HEADERS,
+        )
+    return _aio_session
 
 def fetch_html(url: str) -> str:
-    r = requests.get(url, timeout=30)
+    r = _http.get(url, timeout=30)
     r.raise_for_status()
     return r.text
 
+async def fetch_pages(urls):
+    # fetch all crawl pages concurrently; failures come back as exceptions
+    # and are simply skipped by the caller
+    session = await get_aio_session()
+    async def one(u):
+        async with session.get(u) as r:
+            r.raise_for_status()
+            return await r.text()
+    return await asyncio.gather(*(one(u) for u in urls), return_exceptions=True)
+
+_LINK_TAG_STRAINER = SoupStrainer("link")
+
 def detect_page_path(url: str, html: str) -> str:
     try:
-        soup = BeautifulSoup(html, "html.parser")
+        soup = BeautifulSoup(html, "lxml", parse_only=_LINK_TAG_STRAINER)
         link = soup.find("link", attrs={"rel": ["canonical","Canonical","CANONICAL"]})
         if link and link.get("href"):
             abs_url = urljoin(url, link["href"])
@@ -74,38 +141,44 @@ def detect_page_path(url: str, html: str) -> str:
     return urlparse(url).path or "/"
 
 def clean_html_and_get_dom_chunks(html: str):
-    soup = BeautifulSoup(html, "html.parser")
-    for tag in soup(["script", "style", "noscript"]): tag.decompose()
-    blocks = soup.find_all(["section","article","div","p","li"])
+    # lxml parses and traverses natively in C; no bs4 wrapper objects on this path
+    tree = lxml_html.fromstring(html)
+    etree.strip_elements(tree, "script", "style", "noscript", with_tail=False)
+    blocks = tree.xpath("//section|//article|//div|//p|//li")
     out = []
-    for tag in blocks:
-        inner_html = "".join(str(c) for c in tag.contents)
-        text = tag.get_text(" ", strip=True)
-        if text and len(text) > 20:
+    for el in blocks:
+        text = el.text_content()
+        if text and len(text.strip()) > 20:
+            inner_html = (el.text or "") + "".join(
+                etree.tostring(c, encoding="unicode", method="html") for c in el
+            )
             cleaned = normalize_space(inner_html)
             if cleaned: out.append(cleaned)
     if not out:
-        body = soup.get_text(" ", strip=True)
+        # no content blocks at all: fall back to the whole page's text
+        body = tree.text_content()
         if body: out = [normalize_space(body)]
     return out
 
+_TOK_RE = re.compile(r"\w+|[^\w\s]")
+
 def tokenize_len(text: str) -> int:
-    return len(re.findall(r"\w+|[^\w\s]", text))
+    # count matches without materializing the token list
+    return sum(1 for _ in _TOK_RE.finditer(text))
 
 def chunk_by_token_limit(snippets, limit: int):
     chunks, buf, buf_tokens = [], [], 0
     for snip in snippets:
         t = tokenize_len(snip)
         if t > limit:
-            words = re.findall(r"\S+\s*", snip)
-            tmp, tmp_tokens = [], 0
-            for w in words:
-                wt = tokenize_len(w)
-                if tmp_tokens + wt > limit and tmp:
-                    chunks.append("".join(tmp).strip()); tmp, tmp_tokens = [w], wt
-                else:
-                    tmp.append(w); tmp_tokens += wt
-            if tmp: chunks.append("".join(tmp).strip())
+            # one span pass, then slice the original text at every `limit`
+            # token boundary instead of re-counting tokens word by word
+            spans = [m.span() for m in _TOK_RE.finditer(snip)]
+            for start in range(0, len(spans), limit):
+                lo = spans[start][0]
+                hi = spans[min(start + limit, len(spans)) - 1][1]
+                piece = snip[lo:hi].strip()
+                if piece: chunks.append(piece)
             continue
         if buf_tokens + t > limit and buf:
             chunks.append(" ".join(buf).strip()); buf, buf_tokens = [snip], t
@@ -114,90 +187,190 @@ def chunk_by_token_limit(snippets, limit: int):
     if buf: chunks.append(" ".join(buf).strip())
     return chunks
 
+_TITLE_RE = re.compile(r"<(h1|h2|h3|strong|b|p|li)[^>]*>(.*?)</\1>", re.I | re.S)
+_TAG_STRIP_RE = re.compile(r"<[^>]+>")
+
 def extract_title_from_html(html: str) -> str:
-    try:
-        s = BeautifulSoup(html, "html.parser")
-        for tag in ["h1","h2","h3","strong","b","p","li"]:
-            t = s.find(tag)
-            if t and t.get_text(strip=True):
-                return normalize_space(t.get_text(" ", strip=True))[:140]
-    except Exception: pass
-    return normalize_space(BeautifulSoup(html,"html.parser").get_text(" ", strip=True))[:140]
-
-def upsert_chunks(client, index_name: str, site_id: str, page_url: str, page_path: str, chunks, embedder):
-    index = client.Index(index_name)
-    vecs = embedder.encode(chunks, convert_to_numpy=True, normalize_embeddings=True)
+    # chunks are small HTML fragments, so a regex scan beats building a tree
+    m = _TITLE_RE.search(html)
+    if m:
+        title = normalize_space(_TAG_STRIP_RE.sub(" ", m.group(2)))
+        if title:
+            return title[:140]
+    # miss: strip tags from the whole fragment rather than re-parsing it
+    return normalize_space(_TAG_STRIP_RE.sub(" ", html))[:140]
+
+_EMBED_CACHE = OrderedDict()  # blake2b(chunk) -> vector, LRU-capped
+_EMBED_CACHE_MAX = 10_000
+
+def encode_chunks(embedder, chunks):
+    # boilerplate (nav/footer/sidebar) repeats across pages: encode each
+    # distinct chunk once and reuse cached vectors across requests
+    keys = [hashlib.blake2b(c.encode("utf-8"), digest_size=16).digest() for c in chunks]
+    missing = {}  # order-preserving dedupe of chunks not yet cached
+    for k, c in zip(keys, chunks):
+        if k in _EMBED_CACHE:
+            _EMBED_CACHE.move_to_end(k)
+        elif k not in missing:
+            missing[k] = c
+    if missing:
+        texts = list(missing.values())
+        # smart batching: encode in length order so each batch pads to similar
+        # lengths, then unpermute the embeddings back to input order
+        order = np.argsort([len(t) for t in texts])
+        vecs = embedder.encode(
+            [texts[i] for i in order],
+            batch_size=32, convert_to_numpy=True,
+            normalize_embeddings=True, show_progress_bar=False,
+        )
+        inv = np.empty_like(order); inv[order] = np.arange(len(order))
+        for k, v in zip(missing, vecs[inv]):
+            _EMBED_CACHE[k] = v
+    out = np.stack([_EMBED_CACHE[k] for k in keys])
+    while len(_EMBED_CACHE) > _EMBED_CACHE_MAX:
+        _EMBED_CACHE.popitem(last=False)
+    return out
+
+def upsert_chunks(client, index_name: str, site_id: str, entries, embedder):
+    # entries: (page_url, page_path, chunk_html) across ALL crawled pages, so the
+    # transformer sees one big batch instead of a tiny one per page
+    if not entries:
+        return
+    vecs = encode_chunks(embedder, [html for _, _, html in entries])
+    # one C-level conversion of the whole matrix instead of a per-row .tolist()
+    rows = vecs.astype(np.float32, copy=False).tolist()
     to_upsert = []
-    for i, (html, v) in enumerate(zip(chunks, vecs)):
-        vid = hashlib.sha256(f"{page_url}#{i}".encode("utf-8")).hexdigest()[:40]
+    counters = {}  # per-page chunk counter keeps ids identical to the per-page scheme
+    seen_hashes = set()  # skip exact-duplicate chunks repeated across pages
+    for (page_url, page_path, html), values in zip(entries, rows):
+        i = counters.get(page_url, 0); counters[page_url] = i + 1
+        chunk_hash = hashlib.blake2b(html.encode("utf-8"), digest_size=8).hexdigest()
+        if chunk_hash in seen_hashes:
+            continue
+        seen_hashes.add(chunk_hash)
+        vid = hashlib.blake2b(f"{page_url}#{i}".encode("utf-8"), digest_size=20).hexdigest()
         to_upsert.append({
             "id": vid,
-            "values": v.tolist(),
+            "values": values,
             "metadata": {
                 "site_id": site_id,         # filter across the whole site
                 "page_url": page_url,
                 "path": page_path,
                 "chunk_html": html,
+                "chunk_hash": chunk_hash,
                 "title": extract_title_from_html(html),
             },
         })
-    index.upsert(vectors=to_upsert)
+    if len(to_upsert) <= 100:
+        client.Index(index_name).upsert(vectors=to_upsert)
+    else:
+        # ship 100-vector batches in parallel over the client's thread pool
+        batches = [to_upsert[i:i + 100] for i in range(0, len(to_upsert), 100)]
+        index = client.Index(index_name, pool_threads=min(8, len(batches)))
+        futures = [index.upsert(vectors=b, async_req=True) for b in batches]
+        for f in futures: f.get()
 
 def search_top_k(client, index_name: str, query: str, site_id: str, embedder, top_k: int):
     index = client.Index(index_name)
     qvec = embedder.encode([query], convert_to_numpy=True, normalize_embeddings=True)[0].tolist()
     res = index.query(
-        vector=qvec, top_k=top_k * 3,
+        vector=qvec, top_k=top_k + 5,  # duplicates are dropped at upsert; small headroom is enough
         filter={"site_id": {"$eq": site_id}},
         include_values=False, include_metadata=True,
     )
-    out = []
+    seen, uniq = set(), []
     for m in res.get("matches", []):
         md = m.get("metadata") or {}
+        chunk_html = md.get("chunk_html", "")
+        if not chunk_html:
+            continue
+        # chunk_hash is exact and O(1); prefix fallback covers pre-hash vectors
+        k = md.get("chunk_hash") or chunk_html[:200]
+        if k in seen:
+            continue
+        seen.add(k)
         score = float(m.get("score", 0.0))
-        out.append({
+        uniq.append({
             "raw_score": score,
             "score_percent": int(round((score + 1) / 2 * 100)),
-            "chunk_html": md.get("chunk_html",""),
+            "chunk_html": chunk_html,
             "title": md.get("title"),
             "path": md.get("path","/"),
             "page_url": md.get("page_url"),
         })
-    # dedupe by chunk
-    seen, uniq = set(), []
-    for r in out:
-        k = r["chunk_html"][:200]
-        if k not in seen and r["chunk_html"]:
-            uniq.append(r); seen.add(k)
         if len(uniq) >= top_k: break
     return uniq
 
 # ---- simple same-domain crawler ----
+_LINK_STRAINER = SoupStrainer("a", href=True)
+_NETLOC_END_RE = re.compile(r"[/?#]")  # netloc ends at path, query or fragment
+
 def same_domain_links(start_url: str, html: str, limit: int):
-    soup = BeautifulSoup(html, "html.parser")
-    origin = urlparse(start_url)
-    seen = set([start_url])
+    # strained parse: only <a href> nodes are built, the rest of the page is skipped
+    soup = BeautifulSoup(html, "lxml", parse_only=_LINK_STRAINER)
+    netloc = urlparse(start_url).netloc
+    seen = {start_url}
     q = [start_url]
-    for a in soup.find_all("a", href=True):
-        if len(seen) >= limit: break
-        href = urljoin(start_url, a["href"])
-        u = urlparse(href)
-        if u.scheme in ("http","https") and u.netloc == origin.netloc:
-            if href not in seen:
-                seen.add(href); q.append(href)
+    # limit*4 bounds the traversal; the headroom covers off-domain/duplicate anchors
+    for a in soup.find_all("a", href=True, limit=limit * 4):
         if len(q) >= limit: break
+        href = a["href"]
+        if href.startswith(("http://", "https://")):
+            # cheap netloc check without urlparse on the absolute-URL fast path
+            if _NETLOC_END_RE.split(href.split("://", 1)[1], 1)[0] != netloc:
+                continue
+        else:
+            href = urljoin(start_url, href)
+            u = urlparse(href)
+            if u.scheme not in ("http", "https") or u.netloc != netloc:
+                continue
+        if href not in seen:
+            seen.add(href); q.append(href)
     return q  # includes start_url first
 
+def chunk_pages(urls, page_htmls):
+    # parse + chunk every fetched page; CPU-bound, so callers run it off the loop
+    entries = []
+    for page_url in urls:
+        html = page_htmls.get(page_url)
+        if html is None:
+            continue
+        try:
+            path = detect_page_path(page_url, html)
+            snippets = clean_html_and_get_dom_chunks(html)
+            chunks = chunk_by_token_limit(snippets, CHUNK_TOKEN_LIMIT)
+            entries.extend((page_url, path, c) for c in chunks)
+        except Exception:
+            continue
+    return entries
+
+def site_exists(client, index_name: str, site_id: str, dim: int) -> bool:
+    # presence check: no embedding, no metadata payload, top_k=1. Serverless
+    # indexes don't support filtered describe_index_stats, so a minimal
+    # filtered query is the cheapest predicate available; _indexed_sites
+    # caches the answer so warm sites never hit the network here.
+    if site_id in _indexed_sites:
+        return True
+    res = client.Index(index_name).query(
+        vector=[1.0] + [0.0] * (dim - 1), top_k=1,
+        filter={"site_id": {"$eq": site_id}},
+        include_values=False, include_metadata=False,
+    )
+    if res.get("matches"):
+        _indexed_sites.add(site_id)
+        return True
+    return False
+
 class SearchRequest(BaseModel):
     url: str
     query: str
 
 @app.post("/search")
-def search(req: SearchRequest):
+async def search(req: SearchRequest):
     embedder = get_embedder()
     dim = embedder.get_sentence_embedding_dimension()
     index_name = f"html-chunks-v3-{dim}"  # bump name to avoid stale metadata
-    ensure_index(index_name, dim)
+    await asyncio.to_thread(ensure_index, index_name, dim)
 
     # site-level filter id (scheme+host)
     u = urlparse(req.url)
@@ -205,22 +378,27 @@ def search(req: SearchRequest):
 
     client = pc()
 
-    # probe if site already indexed
-    probe = search_top_k(client, index_name, "the", site_id, embedder, 1)
-    if not probe:
+    # blocking work (requests, parsing, model inference, Pinecone) runs in the
+    # threadpool so a cold-site crawl doesn't stall the event loop; only the
+    # aiohttp fan-out stays on the loop
+    if not await asyncio.to_thread(site_exists, client, index_name, site_id, dim):
         # index start page + a few same-domain links
-        start_html = fetch_html(req.url)
-        urls = same_domain_links(req.url, start_html, MAX_PAGES)
-        for page_url in urls:
-            try:
-                html = start_html if page_url == req.url else fetch_html(page_url)
-                path = detect_page_path(page_url, html)
-                snippets = clean_html_and_get_dom_chunks(html)
-                chunks = chunk_by_token_limit(snippets, CHUNK_TOKEN_LIMIT)
-                if chunks:
-                    upsert_chunks(client, index_name, site_id, page_url, path, chunks, embedder)
-            except Exception:
-                continue
+        # start page first (needed for link discovery), then the rest in parallel
+        start_html = await asyncio.to_thread(fetch_html, req.url)
+        urls = await asyncio.to_thread(same_domain_links, req.url, start_html, MAX_PAGES)
+        rest = [u for u in urls if u != req.url]
+        page_htmls = {req.url: start_html}
+        for page_url, html in zip(rest, await fetch_pages(rest)):
+            if isinstance(html, str):
+                page_htmls[page_url] = html
+        # phase 1: parse + chunk every page
+        entries = await asyncio.to_thread(chunk_pages, urls, page_htmls)
+        # phase 2: one batched encode + upsert across the whole crawl
+        if entries:
+            await asyncio.to_thread(upsert_chunks, client, index_name, site_id, entries, embedder)
+            _indexed_sites.add(site_id)
 
-    results = search_top_k(client, index_name, req.query, site_id, embedder, TOP_K)
+    results = await asyncio.to_thread(
+        search_top_k, client, index_name, req.query, site_id, embedder, TOP_K,
+    )
     return {"results": results}